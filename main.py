@@ -1,30 +1,91 @@
+import hashlib
+import logging
 import os
+import secrets
 import sys
 import time
-from datetime import datetime, timedelta
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
+from cachetools import TTLCache
+import ciso8601
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends, Security
+from fastapi import FastAPI, HTTPException, Depends, Request, Security
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from pydantic import BaseModel, validator
+import orjson
+from pydantic import BaseModel, ValidationError, field_validator, model_validator
 import uvicorn
 
 from gpt_researcher import GPTResearcher
+import httpx
 import asyncio
 import argparse
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Installed before anything has used the loop's default executor, so there is no earlier pool to shut down
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=RESEARCH_THREADPOOL_SIZE))
+    app.state.http = httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+        timeout=60,
+        http2=True,
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        await loop.shutdown_default_executor()
+
 # Set up FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Set up security
 security = HTTPBearer()
 
 # API key (in a real-world scenario, store this securely)
 API_KEY = os.getenv("API_KEY")
+API_KEY_BYTES = (API_KEY or "").encode()
+
+# Time zones are resolved once at import rather than on every use
+_ET = ZoneInfo("America/New_York")
+_UTC = ZoneInfo("UTC")
+
+# Oldest allowed date is 10 years back from now
+_TEN_YEARS = timedelta(days=365*10)
+
+# Prompt text wrapped around every query; filled with %-formatting per request
+_DATE_RESTRICTION_TPL = "IMPORTANT: Only use information from articles and content published between %s and %s (inclusive). Disregard any information outside this date range, even if it seems relevant. If an article's publication date is not clear, do not use it."
+_DATE_RANGE_NOTE_TPL = "\n\nNote: This report only contains information from sources published between %s and %s."
+_CONTEXTUALIZED_QUERY_TPL = "%s\n\nQuery: %s\n\nWhen conducting research and writing the report, continuously verify and mention the publication dates of your sources. Include only information from sources within the specified date range."
+
+# Finished reports, so retries and repeated queries don't rerun the researcher
+_REPORT_CACHE = TTLCache(maxsize=512, ttl=600)
+# Researcher runs in progress; identical requests share their result or exception instead of starting their own
+_REPORTS_IN_FLIGHT: dict[bytes, "_InFlightReport"] = {}
+
+# Upper bound on researchers running at once, to stay inside LLM provider rate limits
+_RESEARCH_SEM = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_RESEARCH", "8")))
+
+# Caps the threads for the researcher's asyncio.to_thread work (search, context compression).
+# Scraping is not covered: each researcher has its own pool of MAX_SCRAPER_WORKERS threads
+RESEARCH_THREADPOOL_SIZE = int(os.getenv("RESEARCH_THREADPOOL_SIZE", "16"))
+
+# Only OpenAI chat models accept an injected httpx client
+_SHARED_HTTP_PROVIDERS = {"openai", "azure_openai"}
+# Retrievers that make LLM calls on their own event loop in a worker thread
+_OWN_LOOP_RETRIEVERS = {"mcp"}
 
 class Query(BaseModel):
     query: str
@@ -33,68 +94,148 @@ class Query(BaseModel):
     end_date: datetime
     sources: list[str] = []
 
-    @validator('start_date', 'end_date', pre=True)
+    @field_validator('start_date', 'end_date', mode='before')
+    @classmethod
     def parse_date(cls, value):
         if isinstance(value, str):
             try:
-                utc_time = datetime.fromisoformat(value.rstrip('Z')).replace(tzinfo=ZoneInfo("UTC"))
-                et_time = utc_time.astimezone(ZoneInfo("America/New_York"))
-                print(f"Original UTC time: {utc_time}, Converted ET time: {et_time}")
-                return et_time
+                utc_time = ciso8601.parse_datetime(value)
+                if utc_time.tzinfo is None:
+                    utc_time = utc_time.replace(tzinfo=_UTC)
+                return utc_time.astimezone(_ET)
             except ValueError as e:
-                print(f"Date parsing error: {e}")
+                logger.debug("Date parsing error: %s", e)
                 raise ValueError("Invalid date format")
         return value
 
-    @validator('start_date', 'end_date')
-    def date_must_be_in_past(cls, v):
-        if v > datetime.now(ZoneInfo("America/New_York")):
-            raise ValueError("Date must be in the past or present")
-        return v
+    @model_validator(mode='after')
+    def dates_must_be_within_range(self):
+        _validate_dates(self.start_date, self.end_date)
+        return self
 
-    @validator('start_date', 'end_date')
-    def dates_must_be_within_range(cls, v):
-        earliest_allowed = datetime.now(ZoneInfo("America/New_York")) - timedelta(days=365*10)  # 10 years ago
-        if v < earliest_allowed:
-            raise ValueError("Date must not be more than 10 years in the past")
-        return v
-
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
+class ResearchResponse(BaseModel):
+    report: str
+    start_date: datetime
+    end_date: datetime
+    execution_time: float
 
 def get_current_time_et():
-    return datetime.now(ZoneInfo("America/New_York"))
+    return datetime.now(_ET)
+
+def _validate_dates(start_date: datetime, end_date: datetime):
+    now = datetime.now(_ET)
+    earliest_allowed = now - _TEN_YEARS
+    for name, d in [("start_date", start_date), ("end_date", end_date)]:
+        if d > now:
+            raise ValueError(f"{name} must be in the past or present")
+        if d < earliest_allowed:
+            raise ValueError(f"{name} must not be more than 10 years in the past")
+
+# Date ranges repeat a lot between requests, so the formatted text for each range is cached
+@lru_cache(maxsize=4096)
+def _date_context(start_date: date, end_date: date) -> tuple[str, str]:
+    # Format dates as strings
+    start_date_str = start_date.isoformat()
+    end_date_str = end_date.isoformat()
+    
+    # Create a strong date restriction message
+    date_restriction = _DATE_RESTRICTION_TPL % (start_date_str, end_date_str)
+    date_range_note = _DATE_RANGE_NOTE_TPL % (start_date_str, end_date_str)
+    return date_restriction, date_range_note
+
+def _report_cache_key(contextualized_query: str, report_type: str, sources: list) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    for part in (contextualized_query, report_type, *sources):
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.digest()
+
+class _QueueStream:
+    """Stands in for the websocket GPTResearcher streams its progress to."""
 
-async def fetch_report(query: str, report_type: str, sources: list, start_date: datetime, end_date: datetime) -> tuple:
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+
+    async def send_json(self, data: dict):
+        await self.queue.put(data)
+
+async def run_researcher(contextualized_query: str, report_type: str, websocket=None) -> str:
+    async with _RESEARCH_SEM:
+        researcher = GPTResearcher(
+            query=contextualized_query, 
+            report_type=report_type, 
+            config_path=None,
+            websocket=websocket
+        )
+        
+        # Reuse the app's keep-alive pool for LLM calls instead of opening fresh connections per researcher.
+        # The client is bound to the server loop and must only be used there, so it is not handed out when
+        # a retriever would pass cfg.llm_kwargs to LLM calls running on another loop
+        http = getattr(app.state, "http", None)
+        cfg = researcher.cfg
+        retrievers = cfg.retrievers.split(",") if isinstance(cfg.retrievers, str) else cfg.retrievers
+        if (
+            http is not None
+            and {cfg.fast_llm_provider, cfg.smart_llm_provider, cfg.strategic_llm_provider} <= _SHARED_HTTP_PROVIDERS
+            and _OWN_LOOP_RETRIEVERS.isdisjoint(r.strip() for r in retrievers)
+        ):
+            cfg.llm_kwargs["http_async_client"] = http
+        
+        await researcher.conduct_research()
+        return await researcher.write_report()
+
+class _InFlightReport:
+    """A detached researcher run and the number of callers still waiting on it."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+async def _produce_report(key: bytes, contextualized_query: str, report_type: str, websocket=None) -> str:
+    try:
+        report = await run_researcher(contextualized_query, report_type, websocket)
+        _REPORT_CACHE[key] = report
+        return report
+    finally:
+        del _REPORTS_IN_FLIGHT[key]
+
+async def get_cached_report(contextualized_query: str, report_type: str, sources: list, websocket=None) -> str:
+    key = _report_cache_key(contextualized_query, report_type, sources)
+    report = _REPORT_CACHE.get(key)
+    if report is not None:
+        return report
+
+    # The run belongs to the in-flight entry rather than to whichever caller started it, so one
+    # caller going away (e.g. a stream client disconnecting) doesn't abort it for the others
+    entry = _REPORTS_IN_FLIGHT.get(key)
+    if entry is None:
+        entry = _REPORTS_IN_FLIGHT[key] = _InFlightReport(
+            asyncio.create_task(_produce_report(key, contextualized_query, report_type, websocket))
+        )
+    entry.waiters += 1
+    try:
+        return await asyncio.shield(entry.task)
+    finally:
+        entry.waiters -= 1
+        # Nobody wants the result any more, so stop spending LLM calls on it
+        if entry.waiters == 0 and not entry.task.done():
+            entry.task.cancel()
+
+async def fetch_report(query: str, report_type: str, sources: list, start_date: datetime, end_date: datetime, websocket=None) -> tuple:
     start_time = time.time()
     
     # Ensure start_date is earlier than end_date
     if start_date > end_date:
         start_date, end_date = end_date, start_date
 
-    # Format dates as strings
-    start_date_str = start_date.strftime('%Y-%m-%d')
-    end_date_str = end_date.strftime('%Y-%m-%d')
-    
-    # Create a strong date restriction message
-    date_restriction = f"IMPORTANT: Only use information from articles and content published between {start_date_str} and {end_date_str} (inclusive). Disregard any information outside this date range, even if it seems relevant. If an article's publication date is not clear, do not use it."
+    date_restriction, date_range_note = _date_context(start_date.date(), end_date.date())
     
     # Modify the query to include the date restriction
-    contextualized_query = f"{date_restriction}\n\nQuery: {query}\n\nWhen conducting research and writing the report, continuously verify and mention the publication dates of your sources. Include only information from sources within the specified date range."
+    contextualized_query = _CONTEXTUALIZED_QUERY_TPL % (date_restriction, query)
 
-    researcher = GPTResearcher(
-        query=contextualized_query, 
-        report_type=report_type, 
-        config_path=None
-    )
-    
-    await researcher.conduct_research()
-    report = await researcher.write_report()
+    report = await get_cached_report(contextualized_query, report_type, sources, websocket)
     
     # Add a note about the date range to the report
-    date_range_note = f"\n\nNote: This report only contains information from sources published between {start_date_str} and {end_date_str}."
     report += date_range_note
     
     end_time = time.time()
@@ -103,15 +244,61 @@ async def fetch_report(query: str, report_type: str, sources: list, start_date:
     return report, execution_time
 
 def verify_api_key(credentials: HTTPAuthorizationCredentials = Security(security)):
-    if credentials.credentials != API_KEY:
+    # Constant-time compare; an unset API_KEY rejects every request
+    if not API_KEY_BYTES or not secrets.compare_digest(credentials.credentials.encode(), API_KEY_BYTES):
         raise HTTPException(status_code=401, detail="Invalid API Key")
     return credentials.credentials
 
-@app.post("/research")
-async def research(query: Query, api_key: str = Depends(verify_api_key)):
-    print(f"Received query: {query}")
+async def _parse_query(request: Request) -> Query:
+    try:
+        return Query.model_validate_json(await request.body())
+    except ValidationError as e:
+        errors = []
+        for err in e.errors(include_url=False):
+            err = {**err, "loc": ("body", *err["loc"])}
+            # Body-level errors (e.g. the date bounds) would echo the whole request body back
+            if len(err["loc"]) == 1:
+                err.pop("input", None)
+            errors.append(err)
+        raise RequestValidationError(errors)
+
+_QUERY_BODY = {"requestBody": {"required": True, "content": {"application/json": {"schema": Query.model_json_schema()}}}}
+
+@app.post("/research", openapi_extra=_QUERY_BODY)
+async def research(request: Request, api_key: str = Depends(verify_api_key)) -> ResearchResponse:
+    query = await _parse_query(request)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Received query len=%d report_type=%s range=%s..%s", len(query.query), query.report_type, query.start_date.date(), query.end_date.date())
     report, execution_time = await fetch_report(query.query, query.report_type, query.sources, query.start_date, query.end_date)
-    return {"report": report, "start_date": query.start_date, "end_date": query.end_date, "execution_time": execution_time}
+    return ResearchResponse(report=report, start_date=query.start_date, end_date=query.end_date, execution_time=execution_time)
+
+async def _stream_report(query: Query):
+    # Progress events from the researcher are forwarded as they arrive, one JSON object per line,
+    # followed by a final "result" line carrying the finished report. Requests served from the
+    # report cache, or joining an identical run already in progress, get no progress events,
+    # only the result line
+    queue = asyncio.Queue()
+    task = asyncio.create_task(fetch_report(query.query, query.report_type, query.sources, query.start_date, query.end_date, _QueueStream(queue)))
+    task.add_done_callback(lambda _: queue.put_nowait(None))
+    try:
+        while (event := await queue.get()) is not None:
+            yield orjson.dumps(event, default=str) + b"\n"
+        report, execution_time = task.result()
+        yield orjson.dumps({"type": "result", "report": report, "start_date": query.start_date, "end_date": query.end_date, "execution_time": execution_time}) + b"\n"
+    except Exception:
+        # Full details stay in the server log; the client only gets an id to quote
+        err_id = uuid.uuid4().hex
+        logger.exception("research failed id=%s", err_id)
+        yield orjson.dumps({"type": "error", "error": f"Error id {err_id}"}) + b"\n"
+    finally:
+        # Stop waiting if the client went away mid-stream; the run itself is only cancelled
+        # once no other request is waiting on it
+        task.cancel()
+
+@app.post("/research_stream", openapi_extra=_QUERY_BODY)
+async def research_stream(request: Request, api_key: str = Depends(verify_api_key)):
+    query = await _parse_query(request)
+    return StreamingResponse(_stream_report(query), media_type="application/x-ndjson")
 
 @app.post("/research_direct")
 async def research_direct(
@@ -121,21 +308,26 @@ async def research_direct(
     start_date: datetime = Depends(get_current_time_et), 
     end_date: datetime = Depends(get_current_time_et),
     api_key: str = Depends(verify_api_key)
-):
+) -> ResearchResponse:
     try:
-        # Validate dates
-        for date in [start_date, end_date]:
-            if date > datetime.now(ZoneInfo("America/New_York")):
-                raise ValueError("Date must be in the past or present")
-            earliest_allowed = datetime.now(ZoneInfo("America/New_York")) - timedelta(days=365*10)
-            if date < earliest_allowed:
-                raise ValueError("Date must not be more than 10 years in the past")
+        _validate_dates(start_date, end_date)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     report, execution_time = await fetch_report(query, report_type, sources, start_date, end_date)
-    return {"report": report, "start_date": start_date, "end_date": end_date, "execution_time": execution_time}
+    return ResearchResponse(report=report, start_date=start_date, end_date=end_date, execution_time=execution_time)
 
+# `python main.py` runs a single uvicorn process, which is fine for development.
+# In production run several workers under gunicorn instead, e.g. on a 4-core host:
+#
+#   gunicorn main:app -k uvicorn.workers.UvicornWorker -w 9 --keep-alive 5
+#
+# (-w is usually 2 * CPU cores + 1). Each worker keeps its own report cache, thread pool and
+# MAX_CONCURRENT_RESEARCH limit, so the cap seen by the LLM provider is
+# -w x MAX_CONCURRENT_RESEARCH (72 with the command above and the default of 8); size it per worker.
+# Threads per worker peak at RESEARCH_THREADPOOL_SIZE + MAX_CONCURRENT_RESEARCH x MAX_SCRAPER_WORKERS
+# (16 + 8 x 15 = 136 by default). MAX_SCRAPER_WORKERS is read by gpt-researcher from the
+# environment; lower it to bound scraping threads.
 def run_fastapi():
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default="0.0.0.0", help="Host to run the server on")
@@ -147,21 +339,15 @@ async def run_terminal():
     parser = argparse.ArgumentParser(description="GPT Researcher")
     parser.add_argument("query", type=str, help="Research query")
     parser.add_argument("--report_type", type=str, default="research_report", help="Type of report")
-    parser.add_argument("--start_date", type=lambda d: datetime.fromisoformat(d).replace(tzinfo=ZoneInfo("America/New_York")),
+    parser.add_argument("--start_date", type=lambda d: datetime.fromisoformat(d).replace(tzinfo=_ET),
                         required=True, help="Start date (YYYY-MM-DD HH:MM:SS in America/New_York)")
-    parser.add_argument("--end_date", type=lambda d: datetime.fromisoformat(d).replace(tzinfo=ZoneInfo("America/New_York")),
+    parser.add_argument("--end_date", type=lambda d: datetime.fromisoformat(d).replace(tzinfo=_ET),
                         required=True, help="End date (YYYY-MM-DD HH:MM:SS in America/New_York)")
     parser.add_argument("--sources", nargs='+', default=[], help="List of source URLs")
     args = parser.parse_args()
     
     try:
-        # Validate dates
-        for date in [args.start_date, args.end_date]:
-            if date > datetime.now(ZoneInfo("America/New_York")):
-                raise ValueError("Date must be in the past or present")
-            earliest_allowed = datetime.now(ZoneInfo("America/New_York")) - timedelta(days=365*10)
-            if date < earliest_allowed:
-                raise ValueError("Date must not be more than 10 years in the past")
+        _validate_dates(args.start_date, args.end_date)
     except ValueError as e:
         print(f"Error: {e}")
         sys.exit(1)